@@ -4,52 +4,107 @@
 # 2-clause BSD license
 
 import argparse
-import io
+import collections
+import concurrent.futures
+import functools
+import itertools
 import json
+import operator
 import os
 import os.path
 import sys
+import types
 import lxml.etree
 
 
 class ClassMapping(object):
     def __init__(self, class_mapping, excludes):
-        self._class_mapping = class_mapping
-        self._excludes = excludes
-
-    def map(self, el):
-        cls, cat, pkg, ver = (el.findtext(x, '')
-                for x in ('class', 'category', 'package', 'version'))
-        if cls in self._excludes.get(cat, {}).get(pkg, {}).get(ver, []):
+        self._class_mapping = dict(class_mapping)
+        # flatten the excludes tree into a set of (cat, pkg, ver, cls)
+        self._excludes = frozenset((cat, pkg, ver, cls)
+                for cat, pkgs in excludes.items()
+                for pkg, vers in pkgs.items()
+                for ver, classes in vers.items()
+                for cls in classes)
+
+    def map_from_fields(self, fields):
+        cat, pkg, ver, cls = (fields.get(x, '')
+                for x in ('category', 'package', 'version', 'class'))
+        if self._excludes and (cat, pkg, ver, cls) in self._excludes:
             return ''
         return self._class_mapping.get(cls, '')
 
 
-class Result(object):
-    def __init__(self, el, class_mapper):
-        self._el = el
-        self._class_mapper = class_mapper
+Result = collections.namedtuple('Result',
+        'category package version cls msg css_class')
+
+
+def make_result(el, class_mapper):
+    fields = dict((c.tag, c.text or '') for c in el)
+    # intern the strings that repeat across many results
+    return Result(
+        category=sys.intern(fields.get('category', '')),
+        package=sys.intern(fields.get('package', '')),
+        version=sys.intern(fields.get('version', '')),
+        cls=sys.intern(fields.get('class', '')),
+        msg=fields.get('msg', ''),
+        css_class=class_mapper.map_from_fields(fields),
+    )
+
+
+result_sort_key = operator.attrgetter(
+        'category', 'package', 'version', 'cls')
+
+
+def parse_results(input_path, class_mapper):
+    if input_path == '-':
+        input_path = sys.stdin.buffer
 
-    def __getattr__(self, key):
-        return self._el.findtext(key) or ''
+    results = []
+    for event, el in lxml.etree.iterparse(input_path, tag='result'):
+        results.append(make_result(el, class_mapper))
+        # free the processed elements as we go
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+    return results
 
-    @property
-    def css_class(self):
-        return self._class_mapper.map(self._el)
 
+def parse_results_in_worker(parse, input_path):
+    try:
+        return parse(input_path)
+    except lxml.etree.XMLSyntaxError as e:
+        # lxml exceptions can not be pickled, so they would not
+        # propagate from the worker processes
+        raise SyntaxError('%s: %s' % (input_path, e.msg)) from None
 
-def result_sort_key(r):
-    return (r.category, r.package, r.version, getattr(r, 'class'))
+
+def reintern_results(results):
+    # strings pickled back from the worker processes are no longer
+    # interned, so intern them again in this process
+    return [r._replace(category=sys.intern(r.category),
+                       package=sys.intern(r.package),
+                       version=sys.intern(r.version),
+                       cls=sys.intern(r.cls))
+            for r in results]
 
 
 def get_results(input_paths, class_mapping, excludes):
     mapper = ClassMapping(class_mapping, excludes)
-    for input_path in input_paths:
-        if input_path == '-':
-            input_path = sys.stdin
-        checks = lxml.etree.parse(input_path).getroot()
-        for r in checks:
-            yield Result(r, mapper)
+    parse = functools.partial(parse_results, class_mapper=mapper)
+    # parse multiple files in parallel (stdin can only be read here)
+    jobs = min(len(input_paths), os.cpu_count() or 1)
+    if jobs > 1 and '-' not in input_paths:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            per_file = [reintern_results(x) for x in
+                        executor.map(parse_results_in_worker,
+                                     itertools.repeat(parse), input_paths)]
+    else:
+        per_file = map(parse, input_paths)
+
+    for results in per_file:
+        for r in results:
+            yield r
 
 
 def split_result_group(it):
@@ -91,6 +146,15 @@ def output_borked(f, results):
         f.write('%s\n' % ('/'.join(g[:2]) if g else 'global'))
 
 
+@functools.lru_cache(maxsize=1)
+def load_class_mapping():
+    # the bundled configuration does not change, so load it only once
+    # (and make it read-only, as it is shared between callers)
+    conf_path = os.path.join(os.path.dirname(__file__), 'pkgcheck2html.conf.json')
+    with open(conf_path, 'rb') as f:
+        return types.MappingProxyType(json.load(f))
+
+
 def main(*args):
     p = argparse.ArgumentParser()
     p.add_argument('-e', '--error', action='store_true',
@@ -108,9 +172,7 @@ def main(*args):
             help='Input XML files')
     args = p.parse_args(args)
 
-    conf_path = os.path.join(os.path.dirname(__file__), 'pkgcheck2html.conf.json')
-    with io.open(conf_path, 'r', encoding='utf8') as f:
-        class_mapping = json.load(f)
+    class_mapping = load_class_mapping()
 
     excludes = {}
     if args.excludes is not None:
@@ -130,8 +192,10 @@ def main(*args):
 
     results = sorted(get_results(args.files, class_mapping, excludes),
                      key=result_sort_key)
-    # filter and group the results
-    results = find_of_class(results, cls)
+    # filter and group the results, skipping the scan if none
+    # of the requested classes can occur
+    cls &= frozenset(class_mapping.values())
+    results = find_of_class(results, cls) if cls else []
 
     if args.output == '-':
         output_borked(sys.stdout, results)
@@ -15,10 +15,13 @@ import lxml.etree
 def get_results(input_paths):
     for input_path in input_paths:
         if input_path == '-':
-            input_path = sys.stdin
-        checks = lxml.etree.parse(input_path).getroot()
-        for r in checks:
+            input_path = sys.stdin.buffer
+        for event, r in lxml.etree.iterparse(input_path, tag='result'):
             yield r
+            # free the processed elements as we go
+            r.clear()
+            while r.getprevious() is not None:
+                del r.getparent()[0]
 
 
 def main(*args):
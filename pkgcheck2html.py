@@ -5,13 +5,19 @@
 
 import argparse
 import collections
+import concurrent.futures
 import datetime
 import email.utils
+import functools
+import hashlib
 import io
+import itertools
 import json
+import operator
 import os
 import os.path
 import sys
+import types
 import lxml.etree
 
 import jinja2
@@ -19,97 +25,144 @@ import jinja2
 
 class ClassMapping(object):
     def __init__(self, class_mapping, excludes):
-        self._class_mapping = class_mapping
-        self._excludes = excludes
-
-    def map(self, el):
-        cls, cat, pkg, ver = (el.findtext(x, '')
-                for x in ('class', 'category', 'package', 'version'))
-        if cls in self._excludes.get(cat, {}).get(pkg, {}).get(ver, []):
+        self._class_mapping = dict(class_mapping)
+        # flatten the excludes tree into a set of (cat, pkg, ver, cls)
+        self._excludes = frozenset((cat, pkg, ver, cls)
+                for cat, pkgs in excludes.items()
+                for pkg, vers in pkgs.items()
+                for ver, classes in vers.items()
+                for cls in classes)
+
+    def map_from_fields(self, fields):
+        cat, pkg, ver, cls = (fields.get(x, '')
+                for x in ('category', 'package', 'version', 'class'))
+        if self._excludes and (cat, pkg, ver, cls) in self._excludes:
             return ''
         return self._class_mapping.get(cls, '')
 
 
-class Result(object):
-    def __init__(self, el, class_mapper):
-        self._el = el
-        self._class_mapper = class_mapper
-
-    def __getattr__(self, key):
-        return self._el.findtext(key) or ''
+Result = collections.namedtuple('Result',
+        'category package version cls msg css_class verbose')
 
-    @property
-    def css_class(self):
-        return self._class_mapper.map(self._el)
 
-    @property
-    def verbose(self):
-        return self.css_class == 'verbose'
+def make_result(el, class_mapper):
+    fields = dict((c.tag, c.text or '') for c in el)
+    css_class = class_mapper.map_from_fields(fields)
+    # intern the strings that repeat across many results
+    return Result(
+        category=sys.intern(fields.get('category', '')),
+        package=sys.intern(fields.get('package', '')),
+        version=sys.intern(fields.get('version', '')),
+        cls=sys.intern(fields.get('class', '')),
+        msg=fields.get('msg', ''),
+        css_class=css_class,
+        verbose=(css_class == 'verbose'),
+    )
 
 
-def result_sort_key(r):
-    return (r.category, r.package, r.version, getattr(r, 'class'))
+result_sort_key = operator.attrgetter(
+        'category', 'package', 'version', 'cls')
 
 
-def get_results(input_paths, class_mapping, excludes, verbose, pkg_filter):
-    mapper = ClassMapping(class_mapping, excludes)
-    for input_path in input_paths:
-        if input_path == '-':
-            input_path = sys.stdin
-        checks = lxml.etree.parse(input_path).getroot()
-        for r in checks:
-            r = Result(r, mapper)
-            if r.verbose and not verbose:
-                continue
-            if not pkg_filter(r):
-                continue
-            yield r
+def parse_results(input_path, class_mapper, verbose):
+    if input_path == '-':
+        input_path = sys.stdin.buffer
 
+    results = []
+    for event, el in lxml.etree.iterparse(input_path, tag='result'):
+        r = make_result(el, class_mapper)
+        # free the processed elements as we go
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+        if r.verbose and not verbose:
+            continue
+        results.append(r)
+    return results
 
-def split_result_group(it):
-    for r in it:
-        if not r.category:
-            yield ((), r)
-        elif not r.package:
-            yield ((r.category,), r)
-        elif not r.version:
-            yield ((r.category, r.package), r)
-        else:
-            yield ((r.category, r.package, r.version), r)
 
+def parse_results_in_worker(parse, input_path):
+    try:
+        return parse(input_path)
+    except lxml.etree.XMLSyntaxError as e:
+        # lxml exceptions can not be pickled, so they would not
+        # propagate from the worker processes
+        raise SyntaxError('%s: %s' % (input_path, e.msg)) from None
 
-def group_results(it, level = 3):
-    prev_group = ()
-    prev_l = []
 
-    for g, r in split_result_group(it):
-        if g[:level] != prev_group:
-            if prev_l:
-                yield (prev_group, prev_l)
-            prev_group = g[:level]
-            prev_l = []
-        prev_l.append(r)
-    yield (prev_group, prev_l)
+def reintern_results(results):
+    # strings pickled back from the worker processes are no longer
+    # interned, so intern them again in this process
+    return [r._replace(category=sys.intern(r.category),
+                       package=sys.intern(r.package),
+                       version=sys.intern(r.version),
+                       cls=sys.intern(r.cls))
+            for r in results]
 
 
-def deep_group(it, level = 1):
-    for g, r in group_results(it, level):
-        if level > 3:
-            for x in r:
-                yield x
-        else:
-            yield (g, deep_group(r, level+1))
+def get_results(input_paths, class_mapping, excludes, verbose, pkg_filter):
+    mapper = ClassMapping(class_mapping, excludes)
+    parse = functools.partial(parse_results, class_mapper=mapper,
+                              verbose=verbose)
+    # parse multiple files in parallel (stdin can only be read here)
+    jobs = min(len(input_paths), os.cpu_count() or 1)
+    if jobs > 1 and '-' not in input_paths:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            per_file = [reintern_results(x) for x in
+                        executor.map(parse_results_in_worker,
+                                     itertools.repeat(parse), input_paths)]
+    else:
+        per_file = map(parse, input_paths)
 
+    for results in per_file:
+        for r in results:
+            if not pkg_filter(r):
+                continue
+            yield r
 
-def find_of_class(it, cls, level = 2):
-    out = collections.defaultdict(set)
 
-    for g, r in group_results(it, level):
-        for x in r:
-            if x.css_class == cls:
-                out[getattr(x, 'class')].add(g)
+def group_results(it, css_classes):
+    groups = []
+    found = dict((c, collections.defaultdict(list)) for c in css_classes)
 
-    return [(k, sorted(v)) for k, v in sorted(out.items())]
+    for cat, cat_it in itertools.groupby(it, operator.attrgetter('category')):
+        cat_g = (cat,) if cat else ()
+        cat_l = []
+        # global results are not split any further
+        if cat:
+            pkgs = itertools.groupby(cat_it, operator.attrgetter('package'))
+        else:
+            pkgs = [('', cat_it)]
+
+        for pkg, pkg_it in pkgs:
+            pkg_g = cat_g + (pkg,) if pkg else cat_g
+            pkg_l = []
+            # category-level results are not split by version either
+            if pkg:
+                vers = itertools.groupby(pkg_it, operator.attrgetter('version'))
+            else:
+                vers = [('', pkg_it)]
+
+            for ver, ver_it in vers:
+                ver_l = list(ver_it)
+                pkg_l.append((pkg_g + (ver,) if ver else pkg_g, ver_l))
+
+                # collect packages having results of the requested classes;
+                # since results are sorted, they are added in order
+                # and duplicates are always adjacent
+                if found:
+                    for r in ver_l:
+                        if r.css_class in found:
+                            found_l = found[r.css_class][r.cls]
+                            if not found_l or found_l[-1] != pkg_g:
+                                found_l.append(pkg_g)
+
+            cat_l.append((pkg_g, pkg_l))
+        groups.append((cat_g, cat_l))
+
+    return (groups,
+            dict((c, sorted(d.items()))
+                 for c, d in found.items()))
 
 
 def get_result_timestamp(paths):
@@ -118,47 +171,97 @@ def get_result_timestamp(paths):
         return datetime.datetime.utcfromtimestamp(st.st_mtime)
 
 
+_email_xpath = lxml.etree.XPath('string(email)', smart_strings=False)
+_projects_xpath = lxml.etree.XPath('project')
+_members_xpath = lxml.etree.XPath('member/email/text()', smart_strings=False)
+_subprojects_xpath = lxml.etree.XPath('subproject[@inherit-members="1"]/@ref',
+                                      smart_strings=False)
+
+
 def format_maint(el):
-    return el.findtext('email').replace('@gentoo.org', '@g.o')
+    return _email_xpath(el).replace('@gentoo.org', '@g.o')
 
 
 class ProjectGetter(object):
     def __init__(self, projects_xml):
         self.projects = lxml.etree.parse(projects_xml).getroot()
+        self._by_email = dict((_email_xpath(x), x)
+                for x in _projects_xpath(self.projects))
+        self._members = None
+        self._cache = {}
 
     def find_projects_for_maintainer(self, m):
-        for x in self.projects.findall('project'):
-            members = frozenset(self[x.findtext('email')])
-            if m in members:
-                yield x.findtext('email')
+        if m not in self._cache:
+            if self._members is None:
+                self._members = dict((k, frozenset(self[k]))
+                        for k in self._by_email)
+            self._cache[m] = tuple(k for k, members in self._members.items()
+                    if m in members)
+        return self._cache[m]
 
     def __getitem__(self, k):
-        for x in self.projects.findall('project'):
-            if x.findtext('email') == k:
-                # project members
-                for m in x.findall('member'):
-                    yield m.findtext('email')
+        x = self._by_email.get(k)
+        if x is None:
+            return
 
-                # inherited subproject members
-                for sp in x.findall('subproject'):
-                    if sp.get('inherit-members') == '1':
-                        for m in self[sp.get('ref')]:
-                            yield m
+        # project members
+        for m in _members_xpath(x):
+            yield m
+
+        # inherited subproject members
+        for sp in _subprojects_xpath(x):
+            for m in self[sp]:
+                yield m
 
 
 class MaintainerGetter(object):
     def __init__(self, repo):
         self.repo = repo
+        self._cache = {}
 
     def __getitem__(self, k):
+        if k not in self._cache:
+            self._cache[k] = self._get_maintainers(k)
+        return self._cache[k]
+
+    def _get_maintainers(self, k):
         p = os.path.join(self.repo, k, 'metadata.xml')
         try:
             metadata = lxml.etree.parse(p).getroot()
-        except OSError:
-            return []
+        except (OSError, lxml.etree.XMLSyntaxError):
+            return ()
+
+        # skip maintainers without an e-mail address
+        maints = tuple(m for m in map(format_maint,
+                                      metadata.findall('maintainer')) if m)
+        return maints if maints else ('maintainer-needed',)
+
+
+@functools.lru_cache(maxsize=None)
+def get_template(name):
+    # keep compiled templates in a cache directory to avoid recompiling
+    # them on every run; Jinja only checks whether the template itself
+    # has changed, so include the extension's checksum in the file name
+    # to invalidate the cache when the compression code changes
+    ext_path = os.path.join(os.path.dirname(__file__), 'jinja2htmlcompress.py')
+    with open(ext_path, 'rb') as f:
+        ext_hash = hashlib.sha1(f.read()).hexdigest()
+    jenv = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+            extensions=['jinja2htmlcompress.HTMLCompress'],
+            bytecode_cache=jinja2.FileSystemBytecodeCache(
+                pattern='pkgcheck2html_%s_%%s.cache' % ext_hash),
+            auto_reload=False)
+    return jenv.get_template(name)
 
-        maints = [format_maint(x) for x in metadata.findall('maintainer')]
-        return maints if maints else ['maintainer-needed']
+
+@functools.lru_cache(maxsize=1)
+def load_class_mapping():
+    # the bundled configuration does not change, so load it only once
+    # (and make it read-only, as it is shared between callers)
+    conf_path = os.path.join(os.path.dirname(__file__), 'pkgcheck2html.conf.json')
+    with open(conf_path, 'rb') as f:
+        return types.MappingProxyType(json.load(f))
 
 
 def main(*args):
@@ -188,22 +291,17 @@ def main(*args):
             help='Input XML files')
     args = p.parse_args(args)
 
-    conf_path = os.path.join(os.path.dirname(__file__), 'pkgcheck2html.conf.json')
-    with io.open(conf_path, 'r', encoding='utf8') as f:
-        class_mapping = json.load(f)
+    class_mapping = load_class_mapping()
 
     excludes = {}
     if args.excludes is not None:
         with open(args.excludes) as f:
             excludes = json.load(f)
 
-    jenv = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
-            extensions=['jinja2htmlcompress.HTMLCompress'])
-    t = jenv.get_template('output.html.jinja')
+    t = get_template('output.html.jinja')
 
     maints = MaintainerGetter(args.repo)
-    maint_filter = lambda x: True
+    match = None
     if args.maintainer:
         if not '@' in args.maintainer:
             args.maintainer += '@gentoo.org'
@@ -221,48 +319,50 @@ def main(*args):
             match = frozenset([x.replace('@gentoo.org', '@g.o') for x in match])
         else:
             match = frozenset(['maintainer-needed'])
-        maint_filter = lambda x: (bool(match.intersection(
-            maints['/'.join((x.category, x.package))])))
-    pkg_filter = lambda x: True
+    packages = None
     if args.pkg:
         packages = frozenset(args.pkg.split(','))
-        pkg_filter = lambda x: (bool(packages.intersection(
-            ['/'.join((x.category, x.package))])))
 
-    combined_filter = lambda x: maint_filter(x) and pkg_filter(x)
+    def result_filter(x):
+        cp = '/'.join((x.category, x.package))
+        if packages is not None and cp not in packages:
+            return False
+        if match is not None and not any(m in match for m in maints[cp]):
+            return False
+        return True
+
     results = sorted(get_results(args.files, class_mapping, excludes,
                                  args.verbose,
-                                 pkg_filter=combined_filter),
+                                 pkg_filter=result_filter),
                      key=result_sort_key)
 
-    types = {}
-    for r in results:
-        cl = getattr(r, 'class')
-        if cl not in types:
-            types[cl] = 0
-        types[cl] += 1
-
     if args.timestamp is not None:
         ts = datetime.datetime.strptime(args.timestamp, '%Y-%m-%d %H:%M:%S')
     else:
         ts = get_result_timestamp(args.files)
 
-    out = t.render(
-        results=deep_group(results),
-        warnings=find_of_class(results, 'warn'),
-        staging=find_of_class(results, 'staging'),
-        errors=find_of_class(results, 'err'),
+    # skip classes that no result can be mapped to
+    mapped = frozenset(class_mapping.values())
+    groups, found = group_results(results,
+            [x for x in ('err', 'warn', 'staging') if x in mapped])
+
+    out = t.stream(
+        results=groups,
+        warnings=found.get('warn', []),
+        staging=found.get('staging', []),
+        errors=found.get('err', []),
         ts=ts,
         maints=maints,
         doc_uri=args.doc_uri,
         revision=args.revision,
     )
+    out.enable_buffering(size=64)
 
     if args.output == '-':
-        sys.stdout.write(out)
+        out.dump(sys.stdout)
     else:
         with io.open(args.output, 'w', encoding='utf8') as f:
-            f.write(out)
+            out.dump(f)
 
 
 if __name__ == '__main__':